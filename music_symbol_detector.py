@@ -8,10 +8,78 @@ around sharps, flats, naturals, and noteheads.
 import os
 import sys
 import subprocess
-import xml.etree.ElementTree as ET
+import glob
+import shutil
+try:
+    import lxml.etree as ET
+    HAVE_LXML = True
+except ImportError:
+    # Fall back to the stdlib parser (C-accelerated where available)
+    try:
+        import xml.etree.cElementTree as ET
+    except ImportError:
+        import xml.etree.ElementTree as ET
+    HAVE_LXML = False
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import argparse
+import functools
+import zipfile
+
+
+@functools.lru_cache(maxsize=8)
+def _font(size):
+    """Load (and cache) the label font at the given size."""
+    try:
+        return ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=1)
+def _discover_audiveris():
+    """Try to find Audiveris installation (looked up once per process)."""
+    possible_paths = [
+        '/Applications/Audiveris.app/Contents/MacOS/Audiveris',
+        '/usr/local/bin/audiveris',
+    ]
+    # Locally built JARs carry a version in their name, so expand the
+    # pattern rather than testing it literally. Prefer the most recent
+    # build; comparing names would put 5.9 ahead of 5.10
+    possible_paths.extend(sorted(
+        glob.glob(os.path.expanduser('~/Audiveris/build/libs/Audiveris-*.jar')),
+        key=os.path.getmtime,
+        reverse=True
+    ))
+
+    for path in possible_paths:
+        if os.path.exists(path):
+            return path
+
+    # Check if audiveris is in PATH
+    return shutil.which('audiveris')
+
+
+def _iter_elements(source, tags):
+    """
+    Stream an XML file or file object, yielding elements named in tags once
+    their end tag is parsed and freeing them afterwards.
+
+    With lxml the tag filtering happens in C and already-handled siblings are
+    dropped from the tree; the stdlib fallback filters in Python and can only
+    clear the yielded elements.
+    """
+    if HAVE_LXML:
+        for _, elem in ET.iterparse(source, events=('end',), tag=tags):
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    else:
+        for _, elem in ET.iterparse(source, events=('end',)):
+            if elem.tag in tags:
+                yield elem
+                elem.clear()
 
 
 class MusicSymbolDetector:
@@ -33,6 +101,27 @@ class MusicSymbolDetector:
         'notehead': '#FF00FF'    # Magenta
     }
 
+    # Audiveris shape names mapped to symbol types; shapes not listed here are
+    # classified by name on first sight and remembered
+    _SHAPE_CACHE = {
+        'NOTEHEAD_BLACK': 'notehead',
+        'NOTEHEAD_BLACK_SMALL': 'notehead',
+        'NOTEHEAD_VOID': 'notehead',
+        'NOTEHEAD_VOID_SMALL': 'notehead',
+        'NOTEHEAD_CROSS': 'notehead',
+        'NOTEHEAD_DIAMOND_FILLED': 'notehead',
+        'NOTEHEAD_DIAMOND_VOID': 'notehead',
+        'SHARP': 'sharp',
+        'DOUBLE_SHARP': 'sharp',
+        'FLAT': 'flat',
+        'DOUBLE_FLAT': 'flat',
+        'NATURAL': 'natural',
+        'WHOLE_NOTE': None,
+        'WHOLE_NOTE_SMALL': None,
+        'BREVE': None,
+        'BREVE_SMALL': None
+    }
+
     def __init__(self, audiveris_path=None):
         """
         Initialize the detector.
@@ -40,31 +129,7 @@ class MusicSymbolDetector:
         Args:
             audiveris_path: Path to Audiveris executable/jar (optional)
         """
-        self.audiveris_path = audiveris_path or self._find_audiveris()
-
-    def _find_audiveris(self):
-        """Try to find Audiveris installation."""
-        possible_paths = [
-            '/Applications/Audiveris.app/Contents/MacOS/Audiveris',
-            '/usr/local/bin/audiveris',
-            'audiveris',
-            os.path.expanduser('~/Audiveris/build/libs/Audiveris-*.jar')
-        ]
-
-        for path in possible_paths:
-            if os.path.exists(path):
-                return path
-
-        # Check if audiveris is in PATH
-        try:
-            result = subprocess.run(['which', 'audiveris'],
-                                  capture_output=True, text=True)
-            if result.returncode == 0:
-                return result.stdout.strip()
-        except:
-            pass
-
-        return None
+        self.audiveris_path = audiveris_path or _discover_audiveris()
 
     def process_image(self, image_path, output_path=None):
         """
@@ -141,10 +206,15 @@ class MusicSymbolDetector:
                 str(image_path)
             ]
 
+        # Audiveris logs heavily, so send its stderr straight to a file
+        # instead of buffering it in memory
+        log_file = output_dir / f"{image_path.stem}.log"
+
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+            with open(log_file, 'wb') as log:
+                result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=log, timeout=300)
             if result.returncode != 0:
-                print(f"Audiveris stderr: {result.stderr}")
+                print(f"Audiveris log: {log_file}")
                 raise RuntimeError(f"Audiveris failed with code {result.returncode}")
         except subprocess.TimeoutExpired:
             raise RuntimeError("Audiveris timed out (5 minutes)")
@@ -172,6 +242,15 @@ class MusicSymbolDetector:
         Returns:
             List of symbol dictionaries with type and bounding box
         """
+        # MusicXML doesn't contain pixel coordinates, so go straight to the
+        # Audiveris book file when there is one and skip parsing the MusicXML
+        omr_dir = omr_file.parent
+        book_file = omr_dir / f"{omr_dir.name}.omr"
+
+        if book_file.exists():
+            print("Parsing Audiveris book file for pixel coordinates...")
+            return self._parse_omr_book(book_file)
+
         symbols = []
 
         try:
@@ -212,21 +291,10 @@ class MusicSymbolDetector:
                     elif 'natural' in acc_type:
                         symbols.append({'type': 'natural', 'element': note})
 
-            # Since MusicXML doesn't contain pixel coordinates, we'll need to
-            # extract them from Audiveris's internal format or estimate
-            print("Note: MusicXML doesn't contain pixel coordinates.")
-            print("Attempting to parse Audiveris book file...")
-
-            # Try to find the .omr file which contains positional data
-            omr_dir = omr_file.parent
-            book_file = omr_dir / f"{omr_dir.name}.omr"
-
-            if book_file.exists():
-                symbols = self._parse_omr_book(book_file)
-            else:
-                print("Warning: Could not find OMR book file with coordinates.")
-                print("Generating estimated positions...")
-                symbols = self._estimate_positions(symbols)
+            # Without the book file there are no pixel coordinates, so estimate
+            print("Warning: Could not find OMR book file with coordinates.")
+            print("Generating estimated positions...")
+            symbols = self._estimate_positions(symbols)
 
         except Exception as e:
             print(f"Error parsing OMR output: {e}")
@@ -236,44 +304,17 @@ class MusicSymbolDetector:
         return symbols
 
     def _parse_omr_book(self, book_file):
-        """Parse Audiveris .omr book file for pixel coordinates."""
+        """Parse Audiveris .omr book file (ZIP archive) for pixel coordinates."""
         symbols = []
 
         try:
-            tree = ET.parse(book_file)
-            root = tree.getroot()
-
-            # Look for inter elements (symbol interpretations)
-            for inter in root.findall('.//inter'):
-                shape = inter.get('shape', '')
-
-                # Check if it's a symbol we're interested in
-                symbol_type = None
-                shape_lower = shape.lower()
-
-                if 'sharp' in shape_lower:
-                    symbol_type = 'sharp'
-                elif 'flat' in shape_lower:
-                    symbol_type = 'flat'
-                elif 'natural' in shape_lower:
-                    symbol_type = 'natural'
-                elif 'notehead' in shape_lower or 'head' in shape_lower:
-                    symbol_type = 'notehead'
-
-                if symbol_type:
-                    # Get bounds
-                    bounds = inter.find('bounds')
-                    if bounds is not None:
-                        x = int(bounds.get('x', 0))
-                        y = int(bounds.get('y', 0))
-                        w = int(bounds.get('w', 20))
-                        h = int(bounds.get('h', 20))
-
-                        symbols.append({
-                            'type': symbol_type,
-                            'bbox': (x, y, x + w, y + h),
-                            'shape': shape
-                        })
+            # The book is a ZIP; read only the sheet XML members, straight out
+            # of the archive, and never touch the binary payload around them
+            with zipfile.ZipFile(book_file, 'r') as zip_ref:
+                for name in zip_ref.namelist():
+                    if name.endswith('.xml') and '/sheet#' in name:
+                        with zip_ref.open(name) as sheet_xml:
+                            symbols.extend(self._parse_sheet_stream(sheet_xml))
 
             print(f"Found {len(symbols)} symbols in OMR book file")
 
@@ -282,6 +323,54 @@ class MusicSymbolDetector:
 
         return symbols
 
+    def _parse_sheet_stream(self, sheet_xml):
+        """Parse the inter elements (symbol interpretations) of one sheet XML stream."""
+        symbols = []
+
+        for inter in _iter_elements(sheet_xml, ('inter',)):
+            shape = inter.get('shape', '')
+
+            # Check if it's a symbol we're interested in
+            symbol_type = self._classify_symbol(shape)
+
+            if symbol_type:
+                # Get bounds
+                bounds = inter.find('bounds')
+                if bounds is not None:
+                    x = int(bounds.get('x', 0))
+                    y = int(bounds.get('y', 0))
+                    w = int(bounds.get('w', 20))
+                    h = int(bounds.get('h', 20))
+
+                    symbols.append({
+                        'type': symbol_type,
+                        'bbox': (x, y, x + w, y + h),
+                        'shape': shape
+                    })
+
+        return symbols
+
+    def _classify_symbol(self, shape):
+        """Classify a shape into our target symbol types."""
+        if shape in self._SHAPE_CACHE:
+            return self._SHAPE_CACHE[shape]
+
+        shape_lower = shape.lower()
+
+        if 'sharp' in shape_lower:
+            symbol_type = 'sharp'
+        elif 'flat' in shape_lower:
+            symbol_type = 'flat'
+        elif 'natural' in shape_lower:
+            symbol_type = 'natural'
+        elif 'notehead' in shape_lower or 'head' in shape_lower:
+            symbol_type = 'notehead'
+        else:
+            symbol_type = None
+
+        self._SHAPE_CACHE[shape] = symbol_type
+        return symbol_type
+
     def _parse_alternative(self, omr_file):
         """Alternative parsing method."""
         # Fallback: return empty list or mock data
@@ -313,13 +402,10 @@ class MusicSymbolDetector:
         img = Image.open(image_path)
         draw = ImageDraw.Draw(img)
 
-        # Try to load a font
-        try:
-            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 20)
-        except:
-            font = ImageFont.load_default()
+        font = _font(20)
 
-        # Draw bounding boxes
+        # Group boxes by symbol type so each color is drawn in one run
+        groups = {}
         for symbol in symbols:
             symbol_type = symbol['type']
             if symbol_type not in self.TARGET_SYMBOLS:
@@ -329,16 +415,24 @@ class MusicSymbolDetector:
             if not bbox:
                 continue
 
-            color = self.COLORS.get(symbol_type, '#FFFFFF')
+            groups.setdefault(symbol_type, []).append(bbox)
 
-            # Draw rectangle
-            draw.rectangle(bbox, outline=color, width=3)
+        # Draw all rectangles first so no box is drawn over a label
+        for symbol_type, bboxes in groups.items():
+            color = self.COLORS.get(symbol_type, '#FFFFFF')
+            for bbox in bboxes:
+                draw.rectangle(bbox, outline=color, width=3)
 
-            # Draw label
+        # Draw labels, measuring each label once instead of once per symbol
+        for symbol_type, bboxes in groups.items():
+            color = self.COLORS.get(symbol_type, '#FFFFFF')
             label = self.TARGET_SYMBOLS[symbol_type]
-            text_bbox = draw.textbbox((bbox[0], bbox[1] - 25), label, font=font)
-            draw.rectangle(text_bbox, fill=color)
-            draw.text((bbox[0], bbox[1] - 25), label, fill='white', font=font)
+            left, top, right, bottom = font.getbbox(label)
+            for bbox in bboxes:
+                text_y = bbox[1] - 25
+                draw.rectangle((bbox[0] + left, text_y + top, bbox[0] + right, text_y + bottom),
+                               fill=color)
+                draw.text((bbox[0], text_y), label, fill='white', font=font)
 
         # Save output
         img.save(output_path)
@@ -11,14 +11,61 @@ Features:
 """
 
 import os
+import hashlib
+import pickle
 import sys
 import subprocess
-import xml.etree.ElementTree as ET
+try:
+    import lxml.etree as ET
+    HAVE_LXML = True
+except ImportError:
+    # Fall back to the stdlib parser (C-accelerated where available)
+    try:
+        import xml.etree.cElementTree as ET
+    except ImportError:
+        import xml.etree.ElementTree as ET
+    HAVE_LXML = False
+import numpy as np
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 import argparse
+import concurrent.futures
+import functools
 import zipfile
-import tempfile
+import re
+import socket
+import time
+
+
+@functools.lru_cache(maxsize=8)
+def _font(size):
+    """Load (and cache) the label font at the given size."""
+    try:
+        return ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def _iter_elements(source, tags):
+    """
+    Stream an XML file or file object, yielding elements named in tags once
+    their end tag is parsed and freeing them afterwards.
+
+    With lxml the tag filtering happens in C and already-handled siblings are
+    dropped from the tree; the stdlib fallback filters in Python and can only
+    clear the yielded elements.
+    """
+    if HAVE_LXML:
+        for _, elem in ET.iterparse(source, events=('end',), tag=tags):
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    else:
+        for _, elem in ET.iterparse(source, events=('end',)):
+            if elem.tag in tags:
+                yield elem
+                elem.clear()
 
 
 class MusicSymbolDetector:
@@ -40,12 +87,182 @@ class MusicSymbolDetector:
         'notehead': '#FF00FF'    # Magenta
     }
 
-    def __init__(self, audiveris_path=None):
-        """Initialize the detector."""
+    # Audiveris shape names mapped to symbol types; shapes not listed here are
+    # classified by name on first sight and remembered
+    _SHAPE_CACHE = {
+        'NOTEHEAD_BLACK': 'notehead',
+        'NOTEHEAD_BLACK_SMALL': 'notehead',
+        'NOTEHEAD_VOID': 'notehead',
+        'NOTEHEAD_VOID_SMALL': 'notehead',
+        'NOTEHEAD_CROSS': 'notehead',
+        'NOTEHEAD_DIAMOND_FILLED': 'notehead',
+        'NOTEHEAD_DIAMOND_VOID': 'notehead',
+        'SHARP': 'sharp',
+        'DOUBLE_SHARP': 'sharp',
+        'FLAT': 'flat',
+        'DOUBLE_FLAT': 'flat',
+        'NATURAL': 'natural',
+        'WHOLE_NOTE': None,
+        'WHOLE_NOTE_SMALL': None,
+        'BREVE': None,
+        'BREVE_SMALL': None
+    }
+
+    # Parsed books are cached here; bump PARSER_VERSION whenever parsing
+    # changes so stale results are ignored
+    CACHE_DIR = Path('~/.cache/music_symbol_detector').expanduser()
+    PARSER_VERSION = 2
+
+    # Boxes of the same type overlapping more than this (IoU) are duplicates;
+    # pairs are compared this many rows at a time
+    DUPLICATE_IOU = 0.9
+    DEDUP_BLOCK_SIZE = 512
+
+    # Audiveris entry point and the default port of the Nailgun server
+    AUDIVERIS_MAIN_CLASS = 'org.audiveris.omr.Main'
+    DEFAULT_NAILGUN_PORT = 2113
+
+    def __init__(self, audiveris_path=None, nailgun_classpath=None,
+                 nailgun_port=DEFAULT_NAILGUN_PORT):
+        """
+        Initialize the detector.
+
+        Args:
+            audiveris_path: Path to Audiveris executable
+            nailgun_classpath: Java classpath holding the Nailgun server and
+                Audiveris jars (optional). When given, a resident JVM is
+                started once and every Audiveris run is sent to it with the
+                `ng` client instead of launching a new JVM.
+            nailgun_port: Local port for the Nailgun server
+        """
         self.audiveris_path = audiveris_path
+        self.nailgun_port = nailgun_port
+        self._nailgun_server = None
+
+        if nailgun_classpath:
+            self._start_nailgun(nailgun_classpath)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Shut down the Nailgun server, if one was started."""
+        if self._nailgun_server is None:
+            return
+
+        # If our server already exited, whatever is on the port isn't ours
+        if self._nailgun_server.poll() is not None:
+            self._nailgun_server = None
+            return
+
+        try:
+            subprocess.run(['ng', '--nailgun-port', str(self.nailgun_port), 'ng-stop'],
+                           capture_output=True, timeout=10)
+            self._nailgun_server.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self._nailgun_server.kill()
+        self._nailgun_server = None
+
+    def _start_nailgun(self, classpath):
+        """Start a Nailgun server hosting Audiveris and wait until it accepts clients."""
+        # Refuse a port someone else is listening on, or we would mistake
+        # their server for ours
+        if self._port_accepts_connections():
+            raise RuntimeError(f"Nailgun port {self.nailgun_port} is already in use")
+
+        self._nailgun_server = subprocess.Popen(
+            ['java', '-cp', classpath, 'com.facebook.nailgun.NGServer',
+             f'127.0.0.1:{self.nailgun_port}'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=self._java_env()
+        )
+
+        for _ in range(100):
+            # Only count the port as ours while our server is still running
+            if self._nailgun_server.poll() is not None:
+                break
+            if self._port_accepts_connections():
+                if self._nailgun_server.poll() is None:
+                    return
+                break
+            time.sleep(0.1)
+
+        self.close()
+        raise RuntimeError("Nailgun server failed to start")
+
+    def _port_accepts_connections(self):
+        """Check whether something is listening on the Nailgun port."""
+        try:
+            socket.create_connection(('127.0.0.1', self.nailgun_port), timeout=1).close()
+            return True
+        except OSError:
+            return False
+
+    def _java_env(self):
+        """Environment pointing Audiveris at the Homebrew OpenJDK."""
+        return {**os.environ, 'JAVA_HOME': '/opt/homebrew/opt/openjdk',
+                'PATH': f'/opt/homebrew/opt/openjdk/bin:{os.environ.get("PATH", "")}'}
 
     def process_image(self, image_path, output_path=None, min_resolution=300):
         """Process a sheet music image and draw bounding boxes."""
+        image_path, output_path = self._resolve_paths(image_path, output_path)
+        processing_image, img = self._prepare_image(image_path)
+
+        try:
+            # Step 1: Run Audiveris on the image
+            print("Running Audiveris...")
+            omr_file = self._run_audiveris(processing_image)
+
+            return self._annotate_image(omr_file, output_path, img)
+        finally:
+            self._remove_temp_image(image_path, processing_image)
+
+    def process_images(self, image_paths):
+        """
+        Process several sheet music images with a single Audiveris run.
+
+        Returns:
+            List of output paths in input order, with None for images
+            Audiveris produced no output for
+        """
+        if not image_paths:
+            return []
+
+        # Check every input before upscaling anything, so a bad batch
+        # doesn't leave temporary files behind
+        resolved = [self._resolve_paths(image_path, None) for image_path in image_paths]
+        self._check_unique_stems([image_path for image_path, _ in resolved])
+
+        jobs = []
+        try:
+            for image_path, output_path in resolved:
+                # Keep only paths, so a large batch doesn't hold every decoded page
+                processing_image, _ = self._prepare_image(image_path)
+                jobs.append((image_path, processing_image, output_path))
+
+            # Step 1: Run Audiveris once for all images so the JVM only starts once
+            print(f"Running Audiveris on {len(jobs)} images...")
+            omr_files = self._run_audiveris_batch(
+                [processing_image for _, processing_image, _ in jobs]
+            )
+
+            # A page Audiveris couldn't read shouldn't cost the rest of the batch
+            output_paths = []
+            for (image_path, processing_image, output_path), omr_file in zip(jobs, omr_files):
+                if omr_file is None:
+                    print(f"Error processing {image_path}: no OMR output", file=sys.stderr)
+                    output_paths.append(None)
+                    continue
+                output_paths.append(
+                    self._annotate_image(omr_file, output_path, processing_image)
+                )
+
+            return output_paths
+        finally:
+            for image_path, processing_image, _ in jobs:
+                self._remove_temp_image(image_path, processing_image)
+
+    def _resolve_paths(self, image_path, output_path):
+        """Check the input image exists and pick a default output path."""
         image_path = Path(image_path)
         if not image_path.exists():
             raise FileNotFoundError(f"Image not found: {image_path}")
@@ -53,6 +270,31 @@ class MusicSymbolDetector:
         if output_path is None:
             output_path = image_path.parent / f"{image_path.stem}_detected{image_path.suffix}"
 
+        return image_path, output_path
+
+    def _check_unique_stems(self, image_paths):
+        """Reject images whose Audiveris books would overwrite each other."""
+        seen = {}
+        for image_path in image_paths:
+            other = seen.get(image_path.stem)
+            if other == image_path:
+                # Both jobs would also share (and delete) one temporary upscale
+                raise ValueError(f"Image {image_path} is listed more than once")
+            if other is not None:
+                raise ValueError(
+                    f"Images {other} and {image_path} share the name '{image_path.stem}'; "
+                    "their Audiveris output would collide, so process them separately"
+                )
+            seen[image_path.stem] = image_path
+
+    def _prepare_image(self, image_path):
+        """
+        Upscale the image if needed.
+
+        Returns:
+            Tuple of the path Audiveris should read and the decoded image
+            to draw on (the upscaled image if we upscaled)
+        """
         print(f"Processing: {image_path}")
 
         # Check resolution and upscale if needed
@@ -64,230 +306,341 @@ class MusicSymbolDetector:
         # Original image is 576x274, upscaling 4x gives 2304x1096
         needs_upscale = img.width < 1200 or img.height < 600
 
-        processing_image = image_path
-
-        if needs_upscale:
-            print("Image resolution too low, upscaling for better detection...")
-            scale_factor = 4
-            temp_upscaled = image_path.parent / f"{image_path.stem}_temp_upscaled.png"
-            upscaled_img = img.resize(
-                (img.width * scale_factor, img.height * scale_factor),
-                Image.Resampling.LANCZOS
-            )
-            upscaled_img.save(temp_upscaled, dpi=(300, 300))
-            print(f"Upscaled to: {upscaled_img.size}")
-            processing_image = temp_upscaled
-        else:
+        if not needs_upscale:
             print("Image resolution sufficient for detection")
-
-        # Step 1: Run Audiveris on the image
-        print("Running Audiveris...")
-        omr_file = self._run_audiveris(processing_image)
-
+            return image_path, img
+
+        print("Image resolution too low, upscaling for better detection...")
+        scale_factor = 4
+        temp_upscaled = image_path.parent / f"{image_path.stem}_temp_upscaled.png"
+        upscaled_img = img.resize(
+            (img.width * scale_factor, img.height * scale_factor),
+            Image.Resampling.LANCZOS
+        )
+        # Temporary file for Audiveris only, so skip expensive compression
+        upscaled_img.save(temp_upscaled, dpi=(300, 300), compress_level=1)
+        print(f"Upscaled to: {upscaled_img.size}")
+
+        return temp_upscaled, upscaled_img
+
+    def _annotate_image(self, omr_file, output_path, img):
+        """
+        Parse the Audiveris output for one image and draw its bounding boxes.
+
+        img is the decoded image to draw on, or the path to read it from.
+        """
         # Step 2: Parse the OMR output
         print("Parsing symbols...")
-        symbols = self._parse_omr_file(omr_file)
+        types, bboxes = self._parse_omr_file(omr_file)
 
         # Step 3: Draw bounding boxes
         print("Drawing bounding boxes...")
-        # If we upscaled, draw on the upscaled image then downscale
-        if needs_upscale:
-            self._draw_bounding_boxes(processing_image, symbols, output_path)
-            # Clean up temp file
-            temp_upscaled.unlink()
-        else:
-            self._draw_bounding_boxes(image_path, symbols, output_path)
+        # If we upscaled, draw on the upscaled image
+        self._draw_bounding_boxes(img, types, bboxes, output_path)
 
         print(f"\nOutput saved to: {output_path}")
-        print(f"Total symbols detected: {len(symbols)}")
-        self._print_summary(symbols)
+        print(f"Total symbols detected: {len(types)}")
+        self._print_summary(types)
 
         return output_path
 
+    def _remove_temp_image(self, image_path, processing_image):
+        """Delete the temporary upscale made by _prepare_image, if any."""
+        if processing_image != image_path:
+            processing_image.unlink(missing_ok=True)
+
     def _run_audiveris(self, image_path):
         """Run Audiveris on the image to extract symbols."""
-        if not self.audiveris_path:
+        omr_file = self._run_audiveris_batch([image_path])[0]
+        if omr_file is None:
+            raise RuntimeError(f"OMR output not found for {image_path}")
+
+        return omr_file
+
+    def _run_audiveris_batch(self, image_paths):
+        """
+        Run Audiveris once over several images and return their .omr files.
+
+        Images Audiveris produced no book for get None, so the rest of the
+        batch can still be used.
+        """
+        if not image_paths:
+            return []
+
+        # All books land in one output directory, named after the image stem
+        self._check_unique_stems(image_paths)
+
+        if self._nailgun_server is not None:
+            # Hand the run to the resident JVM instead of starting a new one
+            launcher = ['ng', '--nailgun-port', str(self.nailgun_port), self.AUDIVERIS_MAIN_CLASS]
+        elif self.audiveris_path:
+            launcher = [self.audiveris_path]
+        else:
             raise RuntimeError("Audiveris path not provided")
 
-        output_dir = image_path.parent / "audiveris_output"
+        output_dir = image_paths[0].parent / "audiveris_output"
         output_dir.mkdir(exist_ok=True)
 
         # Run Audiveris in batch mode
         cmd = [
-            self.audiveris_path,
+            *launcher,
             '-batch',
             '-export',
             '-output', str(output_dir),
-            str(image_path)
+            *[str(image_path) for image_path in image_paths]
         ]
 
+        # Allow five minutes per image
+        timeout_minutes = 5 * len(image_paths)
+
+        # Audiveris logs heavily, so send its stderr straight to a file
+        # instead of buffering it in memory (one log per run, named after
+        # the first image)
+        log_file = output_dir / f"{image_paths[0].stem}.log"
+
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300,
-                                  env={**os.environ, 'JAVA_HOME': '/opt/homebrew/opt/openjdk',
-                                       'PATH': f'/opt/homebrew/opt/openjdk/bin:{os.environ.get("PATH", "")}'})
+            with open(log_file, 'wb') as log:
+                result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=log,
+                                      timeout=timeout_minutes * 60, env=self._java_env())
             if result.returncode != 0:
-                print(f"Audiveris stderr: {result.stderr}")
+                print(f"Audiveris exited with code {result.returncode}, see log: {log_file}")
         except subprocess.TimeoutExpired:
-            raise RuntimeError("Audiveris timed out (5 minutes)")
+            raise RuntimeError(f"Audiveris timed out ({timeout_minutes} minutes)")
 
-        # Find the output .omr file
-        omr_file = output_dir / f"{image_path.stem}.omr"
+        # Find the output .omr files
+        omr_files = []
+        for image_path in image_paths:
+            omr_file = output_dir / f"{image_path.stem}.omr"
 
-        if not omr_file.exists():
-            raise RuntimeError(f"OMR output not found: {omr_file}")
+            if not omr_file.exists():
+                print(f"OMR output not found: {omr_file}")
+                omr_file = None
 
-        return omr_file
+            omr_files.append(omr_file)
+
+        return omr_files
 
     def _parse_omr_file(self, omr_file):
-        """Parse Audiveris .omr file (ZIP archive) to extract symbol positions."""
-        symbols = []
+        """
+        Parse Audiveris .omr file (ZIP archive) to extract symbol positions.
 
-        try:
-            # Extract the .omr file (it's a ZIP)
-            with tempfile.TemporaryDirectory() as temp_dir:
-                with zipfile.ZipFile(omr_file, 'r') as zip_ref:
-                    zip_ref.extractall(temp_dir)
+        Results are cached on disk, so parsing the same book again is a
+        single pickle load.
 
-                # Find sheet XML files
-                temp_path = Path(temp_dir)
-                sheet_dirs = list(temp_path.glob('sheet#*'))
+        Returns:
+            Tuple of symbol types (object array of N names) and bounding
+            boxes (int32 array of shape (N, 4) holding x0, y0, x1, y1)
+        """
+        types = [np.empty(0, dtype=object)]
+        bboxes = [np.empty((0, 4), dtype=np.int32)]
+        complete = True
 
-                for sheet_dir in sheet_dirs:
-                    sheet_xml = sheet_dir / f"{sheet_dir.name}.xml"
-                    if sheet_xml.exists():
-                        symbols.extend(self._parse_sheet_xml(sheet_xml))
+        try:
+            # Reuse an earlier parse of the same book if there is one
+            cache_file = self._parse_cache_file(omr_file)
+            cached = self._load_parse_cache(cache_file)
+            if cached is not None:
+                return cached
+
+            # The .omr file is a ZIP; stream each sheet XML straight out of it
+            with zipfile.ZipFile(omr_file, 'r') as zip_ref:
+                for name in zip_ref.namelist():
+                    if re.match(r'sheet#\d+/sheet#\d+\.xml$', name):
+                        with zip_ref.open(name) as sheet_xml:
+                            sheet_types, sheet_bboxes, sheet_complete = self._parse_sheet_xml(sheet_xml)
+                            types.append(sheet_types)
+                            bboxes.append(sheet_bboxes)
+                            complete = complete and sheet_complete
 
         except Exception as e:
             print(f"Error parsing OMR file: {e}")
+            return np.concatenate(types), np.concatenate(bboxes)
 
-        return symbols
+        result = (np.concatenate(types), np.concatenate(bboxes))
+        # Don't cache partial results, so a later run gets to retry
+        if complete:
+            self._save_parse_cache(cache_file, result)
+        return result
+
+    def _parse_cache_file(self, omr_file):
+        """Cache file for an .omr book, keyed by its contents and PARSER_VERSION."""
+        digest = hashlib.blake2b()
+        with open(omr_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+        return self.CACHE_DIR / f"{digest.hexdigest()}-v{self.PARSER_VERSION}.pkl"
+
+    def _load_parse_cache(self, cache_file):
+        """Return cached parse results, or None if there are none usable."""
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable parse cache {cache_file}: {e}")
+            return None
+
+    def _save_parse_cache(self, cache_file, result):
+        """Store parse results; failing to do so only costs a re-parse later."""
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename, so parallel workers never see a partial file
+            temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            with open(temp_file, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            print(f"Could not write parse cache {cache_file}: {e}")
+
+    def _remove_duplicates(self, types, bboxes):
+        """
+        Drop boxes overlapping an earlier box of the same type.
+
+        Audiveris can report the same symbol more than once (for example as
+        both a key alter and an accidental inter). A box is dropped when its
+        IoU with an earlier box of the same type exceeds DUPLICATE_IOU. IoU is
+        computed with numpy broadcasting, a block of rows at a time so memory
+        stays bounded on dense pages.
+        """
+        keep = np.ones(len(types), dtype=bool)
+        areas = ((bboxes[:, 2] - bboxes[:, 0]).astype(np.int64)
+                 * (bboxes[:, 3] - bboxes[:, 1]))
+
+        for symbol_type in set(types.tolist()):
+            indices = np.flatnonzero(types == symbol_type)
+            boxes = bboxes[indices]
+            box_areas = areas[indices]
+            order = np.arange(len(indices))
+
+            for start in range(0, len(indices), self.DEDUP_BLOCK_SIZE):
+                rows = slice(start, start + self.DEDUP_BLOCK_SIZE)
+
+                ix0 = np.maximum(boxes[rows, None, 0], boxes[None, :, 0])
+                iy0 = np.maximum(boxes[rows, None, 1], boxes[None, :, 1])
+                ix1 = np.minimum(boxes[rows, None, 2], boxes[None, :, 2])
+                iy1 = np.minimum(boxes[rows, None, 3], boxes[None, :, 3])
+
+                intersection = (np.clip(ix1 - ix0, 0, None).astype(np.int64)
+                                * np.clip(iy1 - iy0, 0, None))
+                union = box_areas[rows, None] + box_areas[None, :] - intersection
+                iou = intersection / np.maximum(union, 1)
+
+                # Only compare against earlier boxes so the first one is kept
+                earlier = order[None, :] < order[rows, None]
+                duplicate = ((iou > self.DUPLICATE_IOU) & earlier).any(axis=1)
+                keep[indices[rows][duplicate]] = False
+
+        return types[keep], bboxes[keep]
 
     def _parse_sheet_xml(self, sheet_xml):
-        """Parse a sheet XML file to extract symbol positions."""
-        symbols = []
+        """
+        Parse a sheet XML file or stream into arrays of symbol types and bounding boxes.
+
+        Returns:
+            Tuple of types, bounding boxes and whether the whole sheet parsed
+            (False if an error cut it short and only partial results came back)
+        """
+        types = []
+        bboxes = []
+        complete = True
 
         try:
-            tree = ET.parse(sheet_xml)
-            root = tree.getroot()
-
-            # Look for different types of symbols in the <sig><inters> section
-            inters = root.find('.//sig/inters')
-            if inters is None:
-                print("No inters section found in sheet XML")
-                return symbols
-
-            # Parse head elements (noteheads)
-            for head in inters.findall('.//head'):
-                bounds = head.find('bounds')
+            # Stream the sheet instead of building the whole <sig><inters> tree
+            for elem in _iter_elements(sheet_xml, ('head', 'key-alter', 'inter')):
+                if elem.tag == 'head':
+                    # Head elements (noteheads)
+                    symbol_type = 'notehead'
+                else:
+                    # Key signature alters and <inter> elements carrying
+                    # accidentals (sharps, flats, naturals)
+                    symbol_type = self._classify_symbol(elem.get('shape', ''))
+                    if elem.tag == 'inter' and symbol_type not in ('sharp', 'flat', 'natural'):
+                        symbol_type = None
+
+                bounds = elem.find('bounds') if symbol_type else None
                 if bounds is not None:
                     x = int(bounds.get('x', 0))
                     y = int(bounds.get('y', 0))
                     w = int(bounds.get('w', 20))
                     h = int(bounds.get('h', 20))
 
-                    symbols.append({
-                        'type': 'notehead',
-                        'bbox': (x, y, x + w, y + h),
-                        'shape': head.get('shape', 'NOTEHEAD')
-                    })
-
-            # Parse accidentals (sharps, flats, naturals)
-            for accidental in inters.findall('.//key-alter'):
-                shape = accidental.get('shape', '')
-                bounds = accidental.find('bounds')
-
-                if bounds is not None:
-                    symbol_type = self._classify_symbol(shape)
-                    if symbol_type:
-                        x = int(bounds.get('x', 0))
-                        y = int(bounds.get('y', 0))
-                        w = int(bounds.get('w', 20))
-                        h = int(bounds.get('h', 20))
-
-                        symbols.append({
-                            'type': symbol_type,
-                            'bbox': (x, y, x + w, y + h),
-                            'shape': shape
-                        })
-
-            # Parse all <inter> elements for accidentals
-            for inter in inters.findall('.//inter'):
-                shape = inter.get('shape', '')
-                if 'SHARP' in shape or 'FLAT' in shape or 'NATURAL' in shape:
-                    bounds = inter.find('bounds')
-                    if bounds is not None:
-                        symbol_type = self._classify_symbol(shape)
-                        if symbol_type:
-                            x = int(bounds.get('x', 0))
-                            y = int(bounds.get('y', 0))
-                            w = int(bounds.get('w', 20))
-                            h = int(bounds.get('h', 20))
-
-                            symbols.append({
-                                'type': symbol_type,
-                                'bbox': (x, y, x + w, y + h),
-                                'shape': shape
-                            })
+                    types.append(symbol_type)
+                    bboxes.append((x, y, x + w, y + h))
 
         except Exception as e:
             print(f"Error parsing sheet XML: {e}")
             import traceback
             traceback.print_exc()
+            complete = False
 
-        return symbols
+        # Boxes are only comparable within a sheet, so deduplicate per sheet
+        types, bboxes = self._remove_duplicates(np.asarray(types, dtype=object),
+                                                np.asarray(bboxes, dtype=np.int32).reshape(-1, 4))
+        return types, bboxes, complete
 
     def _classify_symbol(self, shape):
         """Classify a shape into our target symbol types."""
+        if shape in self._SHAPE_CACHE:
+            return self._SHAPE_CACHE[shape]
+
         shape_lower = shape.lower()
 
         if 'sharp' in shape_lower:
-            return 'sharp'
+            symbol_type = 'sharp'
         elif 'flat' in shape_lower:
-            return 'flat'
+            symbol_type = 'flat'
         elif 'natural' in shape_lower:
-            return 'natural'
+            symbol_type = 'natural'
         elif 'notehead' in shape_lower or 'head' in shape_lower:
-            return 'notehead'
-
-        return None
-
-    def _draw_bounding_boxes(self, image_path, symbols, output_path):
-        """Draw bounding boxes on the image."""
-        img = Image.open(image_path)
+            symbol_type = 'notehead'
+        else:
+            symbol_type = None
+
+        self._SHAPE_CACHE[shape] = symbol_type
+        return symbol_type
+
+    def _draw_bounding_boxes(self, image, types, bboxes, output_path):
+        """Draw bounding boxes on the image (a PIL image or a path)."""
+        img = image if isinstance(image, Image.Image) else Image.open(image)
+
+        font = _font(24)
+        small_font = _font(16)
+
+        # Group boxes by symbol type so each color is drawn in one run
+        groups = {symbol_type: bboxes[types == symbol_type].tolist()
+                  for symbol_type in self.TARGET_SYMBOLS}
+
+        # Stamp all rectangles into the pixel array first, so no box is drawn
+        # over a label and Pillow is only needed for the text
+        if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+            # Flatten transparent pages onto white; dropping the alpha channel
+            # would turn the background black and hide the notation
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, 'white')
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        pixels = np.array(img.convert('RGB'))
+        for symbol_type, group in groups.items():
+            rgb = ImageColor.getrgb(self.COLORS.get(symbol_type, '#FFFFFF'))
+            self._stamp_rectangles(pixels, group, rgb)
+
+        img = Image.fromarray(pixels)
         draw = ImageDraw.Draw(img)
 
-        # Try to load a font
-        try:
-            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 24)
-            small_font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 16)
-        except:
-            font = ImageFont.load_default()
-            small_font = font
-
-        # Draw bounding boxes
-        for symbol in symbols:
-            symbol_type = symbol['type']
-            if symbol_type not in self.TARGET_SYMBOLS:
-                continue
-
-            bbox = symbol.get('bbox')
-            if not bbox:
-                continue
-
+        # Draw labels, measuring each label once instead of once per symbol
+        for symbol_type, group in groups.items():
             color = self.COLORS.get(symbol_type, '#FFFFFF')
-
-            # Draw rectangle
-            draw.rectangle(bbox, outline=color, width=3)
-
-            # Draw label
             label = self.TARGET_SYMBOLS[symbol_type]
-            text_y = max(bbox[1] - 30, 0)
-            text_bbox = draw.textbbox((bbox[0], text_y), label, font=font)
-            draw.rectangle(text_bbox, fill=color)
-            draw.text((bbox[0], text_y), label, fill='white', font=font)
+            left, top, right, bottom = font.getbbox(label)
+            for bbox in group:
+                text_y = max(bbox[1] - 30, 0)
+                draw.rectangle((bbox[0] + left, text_y + top, bbox[0] + right, text_y + bottom),
+                               fill=color)
+                draw.text((bbox[0], text_y), label, fill='white', font=font)
 
         # Add info banner
-        info_text = f"Detected: {len(symbols)} symbols"
+        info_text = f"Detected: {len(types)} symbols"
         info_bbox = draw.textbbox((10, 10), info_text, font=small_font)
         draw.rectangle(info_bbox, fill='yellow')
         draw.text((10, 10), info_text, fill='black', font=small_font)
@@ -295,11 +648,28 @@ class MusicSymbolDetector:
         # Save output
         img.save(output_path)
 
-    def _print_summary(self, symbols):
+    def _stamp_rectangles(self, pixels, bboxes, rgb, width=3):
+        """
+        Write rectangle outlines straight into an (H, W, 3) pixel array.
+
+        Matches ImageDraw.rectangle(bbox, outline=rgb, width=width): corners
+        are inclusive and the outline grows inwards. Slice assignment is much
+        cheaper than a Pillow call per box on dense pages.
+        """
+        for x0, y0, x1, y1 in bboxes:
+            # Clamp every index at 0 so boxes off the top/left edge don't wrap
+            # around; slicing already stops at the bottom/right edge
+            rows = slice(max(y0, 0), max(y1 + 1, 0))
+            cols = slice(max(x0, 0), max(x1 + 1, 0))
+            pixels[max(y0, 0):max(y0 + width, 0), cols] = rgb
+            pixels[max(y1 - width + 1, 0):max(y1 + 1, 0), cols] = rgb
+            pixels[rows, max(x0, 0):max(x0 + width, 0)] = rgb
+            pixels[rows, max(x1 - width + 1, 0):max(x1 + 1, 0)] = rgb
+
+    def _print_summary(self, types):
         """Print summary of detected symbols."""
         counts = {}
-        for symbol in symbols:
-            symbol_type = symbol['type']
+        for symbol_type in types:
             counts[symbol_type] = counts.get(symbol_type, 0) + 1
 
         print("\nDetected symbols:")
@@ -309,30 +679,99 @@ class MusicSymbolDetector:
             print(f"  {symbol_type} ({label}): {count} [{color}]")
 
 
+def _process_image_worker(audiveris_path, image_path):
+    """Run the full pipeline for one image inside a worker process."""
+    detector = MusicSymbolDetector(audiveris_path=audiveris_path)
+    return detector.process_image(image_path)
+
+
+def main_batch(image_paths, audiveris_path, max_workers=None):
+    """
+    Process several images in parallel, one Audiveris run per worker process.
+
+    Args:
+        image_paths: Paths to input images (PNG/JPG)
+        audiveris_path: Path to Audiveris executable
+        max_workers: Number of worker processes (default: half the CPU count)
+
+    Returns:
+        List of output paths in input order, with None for failed images
+    """
+    if max_workers is None:
+        # Each Audiveris JVM is multithreaded itself, so only use half the cores
+        max_workers = max(1, (os.cpu_count() or 2) // 2)
+
+    output_paths = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_process_image_worker, audiveris_path, image_path)
+                   for image_path in image_paths]
+
+        for image_path, future in zip(image_paths, futures):
+            try:
+                output_paths.append(future.result())
+            except Exception as e:
+                print(f"Error processing {image_path}: {e}", file=sys.stderr)
+                output_paths.append(None)
+
+    return output_paths
+
+
 def main():
     """Main entry point."""
     parser = argparse.ArgumentParser(
         description='Detect and visualize music symbols in sheet music images'
     )
     parser.add_argument(
-        'image',
-        help='Path to input image (PNG or JPG)'
+        'images',
+        nargs='+',
+        metavar='image',
+        help='Path to input image (PNG or JPG); several images are processed in parallel'
     )
     parser.add_argument(
         '-o', '--output',
-        help='Path to output image (optional)'
+        help='Path to output image (optional, single image only)'
     )
     parser.add_argument(
         '-a', '--audiveris',
         required=True,
         help='Path to Audiveris executable'
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        help='Number of images to process at once (default: half the CPU count)'
+    )
+    parser.add_argument(
+        '--nailgun-classpath',
+        help='Classpath with the Nailgun server and Audiveris jars, to run '
+             'Audiveris in a resident JVM (optional, single image only)'
+    )
+    parser.add_argument(
+        '--nailgun-port',
+        type=int,
+        default=MusicSymbolDetector.DEFAULT_NAILGUN_PORT,
+        help='Local port for the Nailgun server (default: %(default)s)'
+    )
 
     args = parser.parse_args()
 
+    if len(args.images) > 1:
+        if args.output or args.nailgun_classpath:
+            parser.error("--output and --nailgun-classpath only apply to a single image")
+
+        output_paths = main_batch(args.images, args.audiveris, args.jobs)
+        if None in output_paths:
+            sys.exit(1)
+        return
+
     try:
-        detector = MusicSymbolDetector(audiveris_path=args.audiveris)
-        detector.process_image(args.image, args.output)
+        detector = MusicSymbolDetector(audiveris_path=args.audiveris,
+                                       nailgun_classpath=args.nailgun_classpath,
+                                       nailgun_port=args.nailgun_port)
+        try:
+            detector.process_image(args.images[0], args.output)
+        finally:
+            detector.close()
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         import traceback
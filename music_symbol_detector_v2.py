@@ -6,14 +6,58 @@ around sharps, flats, naturals, and noteheads.
 """
 
 import os
+import hashlib
+import pickle
 import sys
 import subprocess
-import xml.etree.ElementTree as ET
+try:
+    import lxml.etree as ET
+    HAVE_LXML = True
+except ImportError:
+    # Fall back to the stdlib parser (C-accelerated where available)
+    try:
+        import xml.etree.cElementTree as ET
+    except ImportError:
+        import xml.etree.ElementTree as ET
+    HAVE_LXML = False
+import numpy as np
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 import argparse
+import functools
 import zipfile
-import tempfile
+import re
+
+
+@functools.lru_cache(maxsize=8)
+def _font(size):
+    """Load (and cache) the label font at the given size."""
+    try:
+        return ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def _iter_elements(source, tags):
+    """
+    Stream an XML file or file object, yielding elements named in tags once
+    their end tag is parsed and freeing them afterwards.
+
+    With lxml the tag filtering happens in C and already-handled siblings are
+    dropped from the tree; the stdlib fallback filters in Python and can only
+    clear the yielded elements.
+    """
+    if HAVE_LXML:
+        for _, elem in ET.iterparse(source, events=('end',), tag=tags):
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    else:
+        for _, elem in ET.iterparse(source, events=('end',)):
+            if elem.tag in tags:
+                yield elem
+                elem.clear()
 
 
 class MusicSymbolDetector:
@@ -35,6 +79,37 @@ class MusicSymbolDetector:
         'notehead': '#FF00FF'    # Magenta
     }
 
+    # Audiveris shape names mapped to symbol types; shapes not listed here are
+    # classified by name on first sight and remembered
+    _SHAPE_CACHE = {
+        'NOTEHEAD_BLACK': 'notehead',
+        'NOTEHEAD_BLACK_SMALL': 'notehead',
+        'NOTEHEAD_VOID': 'notehead',
+        'NOTEHEAD_VOID_SMALL': 'notehead',
+        'NOTEHEAD_CROSS': 'notehead',
+        'NOTEHEAD_DIAMOND_FILLED': 'notehead',
+        'NOTEHEAD_DIAMOND_VOID': 'notehead',
+        'SHARP': 'sharp',
+        'DOUBLE_SHARP': 'sharp',
+        'FLAT': 'flat',
+        'DOUBLE_FLAT': 'flat',
+        'NATURAL': 'natural',
+        'WHOLE_NOTE': None,
+        'WHOLE_NOTE_SMALL': None,
+        'BREVE': None,
+        'BREVE_SMALL': None
+    }
+
+    # Parsed books are cached here; bump PARSER_VERSION whenever parsing
+    # changes so stale results are ignored
+    CACHE_DIR = Path('~/.cache/music_symbol_detector').expanduser()
+    PARSER_VERSION = 2
+
+    # Boxes of the same type overlapping more than this (IoU) are duplicates;
+    # pairs are compared this many rows at a time
+    DUPLICATE_IOU = 0.9
+    DEDUP_BLOCK_SIZE = 512
+
     def __init__(self, audiveris_path=None):
         """Initialize the detector."""
         self.audiveris_path = audiveris_path
@@ -50,21 +125,25 @@ class MusicSymbolDetector:
 
         print(f"Processing: {image_path}")
 
+        # Decode the image once up front and reuse it for drawing
+        src_img = Image.open(image_path)
+        src_img.load()
+
         # Step 1: Run Audiveris on the image
         print("Running Audiveris...")
         omr_file = self._run_audiveris(image_path)
 
         # Step 2: Parse the OMR output
         print("Parsing symbols...")
-        symbols = self._parse_omr_file(omr_file)
+        types, bboxes = self._parse_omr_file(omr_file)
 
         # Step 3: Draw bounding boxes
         print("Drawing bounding boxes...")
-        self._draw_bounding_boxes(image_path, symbols, output_path)
+        self._draw_bounding_boxes(src_img, types, bboxes, output_path)
 
         print(f"Output saved to: {output_path}")
-        print(f"Total symbols detected: {len(symbols)}")
-        self._print_summary(symbols)
+        print(f"Total symbols detected: {len(types)}")
+        self._print_summary(types)
 
         return output_path
 
@@ -85,12 +164,17 @@ class MusicSymbolDetector:
             str(image_path)
         ]
 
+        # Audiveris logs heavily, so send its stderr straight to a file
+        # instead of buffering it in memory
+        log_file = output_dir / f"{image_path.stem}.log"
+
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300,
-                                  env={**os.environ, 'JAVA_HOME': '/opt/homebrew/opt/openjdk',
-                                       'PATH': f'/opt/homebrew/opt/openjdk/bin:{os.environ.get("PATH", "")}'})
+            with open(log_file, 'wb') as log:
+                result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=log, timeout=300,
+                                      env={**os.environ, 'JAVA_HOME': '/opt/homebrew/opt/openjdk',
+                                           'PATH': f'/opt/homebrew/opt/openjdk/bin:{os.environ.get("PATH", "")}'})
             if result.returncode != 0:
-                print(f"Audiveris stderr: {result.stderr}")
+                print(f"Audiveris exited with code {result.returncode}, see log: {log_file}")
         except subprocess.TimeoutExpired:
             raise RuntimeError("Audiveris timed out (5 minutes)")
 
@@ -103,155 +187,226 @@ class MusicSymbolDetector:
         return omr_file
 
     def _parse_omr_file(self, omr_file):
-        """Parse Audiveris .omr file (ZIP archive) to extract symbol positions."""
-        symbols = []
+        """
+        Parse Audiveris .omr file (ZIP archive) to extract symbol positions.
 
-        try:
-            # Extract the .omr file (it's a ZIP)
-            with tempfile.TemporaryDirectory() as temp_dir:
-                with zipfile.ZipFile(omr_file, 'r') as zip_ref:
-                    zip_ref.extractall(temp_dir)
+        Results are cached on disk, so parsing the same book again is a
+        single pickle load.
 
-                # Find sheet XML files
-                temp_path = Path(temp_dir)
-                sheet_dirs = list(temp_path.glob('sheet#*'))
+        Returns:
+            Tuple of symbol types (object array of N names) and bounding
+            boxes (int32 array of shape (N, 4) holding x0, y0, x1, y1)
+        """
+        types = [np.empty(0, dtype=object)]
+        bboxes = [np.empty((0, 4), dtype=np.int32)]
+        complete = True
 
-                for sheet_dir in sheet_dirs:
-                    sheet_xml = sheet_dir / f"{sheet_dir.name}.xml"
-                    if sheet_xml.exists():
-                        symbols.extend(self._parse_sheet_xml(sheet_xml))
+        try:
+            # Reuse an earlier parse of the same book if there is one
+            cache_file = self._parse_cache_file(omr_file)
+            cached = self._load_parse_cache(cache_file)
+            if cached is not None:
+                return cached
+
+            # The .omr file is a ZIP; stream each sheet XML straight out of it
+            with zipfile.ZipFile(omr_file, 'r') as zip_ref:
+                for name in zip_ref.namelist():
+                    if re.match(r'sheet#\d+/sheet#\d+\.xml$', name):
+                        with zip_ref.open(name) as sheet_xml:
+                            sheet_types, sheet_bboxes, sheet_complete = self._parse_sheet_xml(sheet_xml)
+                            types.append(sheet_types)
+                            bboxes.append(sheet_bboxes)
+                            complete = complete and sheet_complete
 
         except Exception as e:
             print(f"Error parsing OMR file: {e}")
+            return np.concatenate(types), np.concatenate(bboxes)
+
+        result = (np.concatenate(types), np.concatenate(bboxes))
+        # Don't cache partial results, so a later run gets to retry
+        if complete:
+            self._save_parse_cache(cache_file, result)
+        return result
+
+    def _parse_cache_file(self, omr_file):
+        """Cache file for an .omr book, keyed by its contents and PARSER_VERSION."""
+        digest = hashlib.blake2b()
+        with open(omr_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+        return self.CACHE_DIR / f"{digest.hexdigest()}-v{self.PARSER_VERSION}.pkl"
 
-        return symbols
+    def _load_parse_cache(self, cache_file):
+        """Return cached parse results, or None if there are none usable."""
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable parse cache {cache_file}: {e}")
+            return None
+
+    def _save_parse_cache(self, cache_file, result):
+        """Store parse results; failing to do so only costs a re-parse later."""
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename, so parallel workers never see a partial file
+            temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            with open(temp_file, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            print(f"Could not write parse cache {cache_file}: {e}")
+
+    def _remove_duplicates(self, types, bboxes):
+        """
+        Drop boxes overlapping an earlier box of the same type.
+
+        Audiveris can report the same symbol more than once (for example as
+        both a key alter and an accidental inter). A box is dropped when its
+        IoU with an earlier box of the same type exceeds DUPLICATE_IOU. IoU is
+        computed with numpy broadcasting, a block of rows at a time so memory
+        stays bounded on dense pages.
+        """
+        keep = np.ones(len(types), dtype=bool)
+        areas = ((bboxes[:, 2] - bboxes[:, 0]).astype(np.int64)
+                 * (bboxes[:, 3] - bboxes[:, 1]))
+
+        for symbol_type in set(types.tolist()):
+            indices = np.flatnonzero(types == symbol_type)
+            boxes = bboxes[indices]
+            box_areas = areas[indices]
+            order = np.arange(len(indices))
+
+            for start in range(0, len(indices), self.DEDUP_BLOCK_SIZE):
+                rows = slice(start, start + self.DEDUP_BLOCK_SIZE)
+
+                ix0 = np.maximum(boxes[rows, None, 0], boxes[None, :, 0])
+                iy0 = np.maximum(boxes[rows, None, 1], boxes[None, :, 1])
+                ix1 = np.minimum(boxes[rows, None, 2], boxes[None, :, 2])
+                iy1 = np.minimum(boxes[rows, None, 3], boxes[None, :, 3])
+
+                intersection = (np.clip(ix1 - ix0, 0, None).astype(np.int64)
+                                * np.clip(iy1 - iy0, 0, None))
+                union = box_areas[rows, None] + box_areas[None, :] - intersection
+                iou = intersection / np.maximum(union, 1)
+
+                # Only compare against earlier boxes so the first one is kept
+                earlier = order[None, :] < order[rows, None]
+                duplicate = ((iou > self.DUPLICATE_IOU) & earlier).any(axis=1)
+                keep[indices[rows][duplicate]] = False
+
+        return types[keep], bboxes[keep]
 
     def _parse_sheet_xml(self, sheet_xml):
-        """Parse a sheet XML file to extract symbol positions."""
-        symbols = []
+        """
+        Parse a sheet XML file or stream into arrays of symbol types and bounding boxes.
+
+        Returns:
+            Tuple of types, bounding boxes and whether the whole sheet parsed
+            (False if an error cut it short and only partial results came back)
+        """
+        types = []
+        bboxes = []
+        complete = True
 
         try:
-            tree = ET.parse(sheet_xml)
-            root = tree.getroot()
-
-            # Look for different types of symbols in the <sig><inters> section
-            inters = root.find('.//sig/inters')
-            if inters is None:
-                print("No inters section found in sheet XML")
-                return symbols
-
-            # Parse head elements (noteheads)
-            for head in inters.findall('.//head'):
-                bounds = head.find('bounds')
+            # Stream the sheet instead of building the whole <sig><inters> tree
+            for elem in _iter_elements(sheet_xml, ('head', 'key-alter', 'inter')):
+                if elem.tag == 'head':
+                    # Head elements (noteheads)
+                    symbol_type = 'notehead'
+                else:
+                    # Key signature alters and <inter> elements carrying
+                    # accidentals (sharps, flats, naturals)
+                    symbol_type = self._classify_symbol(elem.get('shape', ''))
+                    if elem.tag == 'inter' and symbol_type not in ('sharp', 'flat', 'natural'):
+                        symbol_type = None
+
+                bounds = elem.find('bounds') if symbol_type else None
                 if bounds is not None:
                     x = int(bounds.get('x', 0))
                     y = int(bounds.get('y', 0))
                     w = int(bounds.get('w', 20))
                     h = int(bounds.get('h', 20))
 
-                    symbols.append({
-                        'type': 'notehead',
-                        'bbox': (x, y, x + w, y + h),
-                        'shape': head.get('shape', 'NOTEHEAD')
-                    })
-
-            # Parse accidentals (sharps, flats, naturals)
-            for accidental in inters.findall('.//key-alter'):
-                shape = accidental.get('shape', '')
-                bounds = accidental.find('bounds')
-
-                if bounds is not None:
-                    symbol_type = self._classify_symbol(shape)
-                    if symbol_type:
-                        x = int(bounds.get('x', 0))
-                        y = int(bounds.get('y', 0))
-                        w = int(bounds.get('w', 20))
-                        h = int(bounds.get('h', 20))
-
-                        symbols.append({
-                            'type': symbol_type,
-                            'bbox': (x, y, x + w, y + h),
-                            'shape': shape
-                        })
-
-            # Parse all <inter> elements for accidentals
-            for inter in inters.findall('.//inter'):
-                shape = inter.get('shape', '')
-                if 'SHARP' in shape or 'FLAT' in shape or 'NATURAL' in shape:
-                    bounds = inter.find('bounds')
-                    if bounds is not None:
-                        symbol_type = self._classify_symbol(shape)
-                        if symbol_type:
-                            x = int(bounds.get('x', 0))
-                            y = int(bounds.get('y', 0))
-                            w = int(bounds.get('w', 20))
-                            h = int(bounds.get('h', 20))
-
-                            symbols.append({
-                                'type': symbol_type,
-                                'bbox': (x, y, x + w, y + h),
-                                'shape': shape
-                            })
+                    types.append(symbol_type)
+                    bboxes.append((x, y, x + w, y + h))
 
         except Exception as e:
             print(f"Error parsing sheet XML: {e}")
             import traceback
             traceback.print_exc()
+            complete = False
 
-        return symbols
+        # Boxes are only comparable within a sheet, so deduplicate per sheet
+        types, bboxes = self._remove_duplicates(np.asarray(types, dtype=object),
+                                                np.asarray(bboxes, dtype=np.int32).reshape(-1, 4))
+        return types, bboxes, complete
 
     def _classify_symbol(self, shape):
         """Classify a shape into our target symbol types."""
+        if shape in self._SHAPE_CACHE:
+            return self._SHAPE_CACHE[shape]
+
         shape_lower = shape.lower()
 
         if 'sharp' in shape_lower:
-            return 'sharp'
+            symbol_type = 'sharp'
         elif 'flat' in shape_lower:
-            return 'flat'
+            symbol_type = 'flat'
         elif 'natural' in shape_lower:
-            return 'natural'
+            symbol_type = 'natural'
         elif 'notehead' in shape_lower or 'head' in shape_lower:
-            return 'notehead'
-
-        return None
-
-    def _draw_bounding_boxes(self, image_path, symbols, output_path):
-        """Draw bounding boxes on the image."""
-        img = Image.open(image_path)
+            symbol_type = 'notehead'
+        else:
+            symbol_type = None
+
+        self._SHAPE_CACHE[shape] = symbol_type
+        return symbol_type
+
+    def _draw_bounding_boxes(self, image, types, bboxes, output_path):
+        """Draw bounding boxes on the image (a PIL image or a path)."""
+        img = image if isinstance(image, Image.Image) else Image.open(image)
+
+        font = _font(24)
+        small_font = _font(16)
+
+        # Group boxes by symbol type so each color is drawn in one run
+        groups = {symbol_type: bboxes[types == symbol_type].tolist()
+                  for symbol_type in self.TARGET_SYMBOLS}
+
+        # Stamp all rectangles into the pixel array first, so no box is drawn
+        # over a label and Pillow is only needed for the text
+        if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+            # Flatten transparent pages onto white; dropping the alpha channel
+            # would turn the background black and hide the notation
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, 'white')
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        pixels = np.array(img.convert('RGB'))
+        for symbol_type, group in groups.items():
+            rgb = ImageColor.getrgb(self.COLORS.get(symbol_type, '#FFFFFF'))
+            self._stamp_rectangles(pixels, group, rgb)
+
+        img = Image.fromarray(pixels)
         draw = ImageDraw.Draw(img)
 
-        # Try to load a font
-        try:
-            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 24)
-            small_font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 16)
-        except:
-            font = ImageFont.load_default()
-            small_font = font
-
-        # Draw bounding boxes
-        for symbol in symbols:
-            symbol_type = symbol['type']
-            if symbol_type not in self.TARGET_SYMBOLS:
-                continue
-
-            bbox = symbol.get('bbox')
-            if not bbox:
-                continue
-
+        # Draw labels, measuring each label once instead of once per symbol
+        for symbol_type, group in groups.items():
             color = self.COLORS.get(symbol_type, '#FFFFFF')
-
-            # Draw rectangle
-            draw.rectangle(bbox, outline=color, width=3)
-
-            # Draw label
             label = self.TARGET_SYMBOLS[symbol_type]
-            text_y = max(bbox[1] - 30, 0)
-            text_bbox = draw.textbbox((bbox[0], text_y), label, font=font)
-            draw.rectangle(text_bbox, fill=color)
-            draw.text((bbox[0], text_y), label, fill='white', font=font)
+            left, top, right, bottom = font.getbbox(label)
+            for bbox in group:
+                text_y = max(bbox[1] - 30, 0)
+                draw.rectangle((bbox[0] + left, text_y + top, bbox[0] + right, text_y + bottom),
+                               fill=color)
+                draw.text((bbox[0], text_y), label, fill='white', font=font)
 
         # Add info banner
-        info_text = f"Detected: {len(symbols)} symbols"
+        info_text = f"Detected: {len(types)} symbols"
         info_bbox = draw.textbbox((10, 10), info_text, font=small_font)
         draw.rectangle(info_bbox, fill='yellow')
         draw.text((10, 10), info_text, fill='black', font=small_font)
@@ -259,11 +414,28 @@ class MusicSymbolDetector:
         # Save output
         img.save(output_path)
 
-    def _print_summary(self, symbols):
+    def _stamp_rectangles(self, pixels, bboxes, rgb, width=3):
+        """
+        Write rectangle outlines straight into an (H, W, 3) pixel array.
+
+        Matches ImageDraw.rectangle(bbox, outline=rgb, width=width): corners
+        are inclusive and the outline grows inwards. Slice assignment is much
+        cheaper than a Pillow call per box on dense pages.
+        """
+        for x0, y0, x1, y1 in bboxes:
+            # Clamp every index at 0 so boxes off the top/left edge don't wrap
+            # around; slicing already stops at the bottom/right edge
+            rows = slice(max(y0, 0), max(y1 + 1, 0))
+            cols = slice(max(x0, 0), max(x1 + 1, 0))
+            pixels[max(y0, 0):max(y0 + width, 0), cols] = rgb
+            pixels[max(y1 - width + 1, 0):max(y1 + 1, 0), cols] = rgb
+            pixels[rows, max(x0, 0):max(x0 + width, 0)] = rgb
+            pixels[rows, max(x1 - width + 1, 0):max(x1 + 1, 0)] = rgb
+
+    def _print_summary(self, types):
         """Print summary of detected symbols."""
         counts = {}
-        for symbol in symbols:
-            symbol_type = symbol['type']
+        for symbol_type in types:
             counts[symbol_type] = counts.get(symbol_type, 0) + 1
 
         print("\nDetected symbols:")
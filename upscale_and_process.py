@@ -3,19 +3,41 @@
 Upscale image and process with Audiveris
 """
 
+import os
 import sys
 from PIL import Image
 
 def upscale_image(input_path, output_path, scale_factor=4):
     """Upscale image for better Audiveris processing."""
+    if scale_factor <= 0:
+        raise ValueError(f"Scale factor must be positive, got {scale_factor}")
+
     img = Image.open(input_path)
     print(f"Original size: {img.size}")
 
-    new_size = (img.width * scale_factor, img.height * scale_factor)
-    img_upscaled = img.resize(new_size, Image.Resampling.LANCZOS)
+    # Tiny fractional factors would round a side down to 0 pixels
+    new_size = (max(1, int(img.width * scale_factor)), max(1, int(img.height * scale_factor)))
+
+    # When shrinking a JPEG, let the decoder downscale during the IDCT so the
+    # full-resolution image is never decoded; LANCZOS handles the remainder
+    if img.format == 'JPEG' and scale_factor < 1:
+        img.draft(img.mode, new_size)
+
+    img_upscaled = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
 
     print(f"New size: {img_upscaled.size}")
-    img_upscaled.save(output_path, dpi=(300, 300))
+
+    # The output is an intermediate file for Audiveris, so favour fast encoding
+    # over file size
+    extension = os.path.splitext(str(output_path))[1].lower()
+    if extension == '.png':
+        save_options = {'compress_level': 1, 'optimize': False}
+    elif extension in ('.tif', '.tiff'):
+        save_options = {'compression': 'tiff_lzw'}
+    else:
+        save_options = {}
+
+    img_upscaled.save(output_path, dpi=(300, 300), **save_options)
     print(f"Saved to: {output_path}")
 
     return output_path
@@ -25,5 +47,9 @@ if __name__ == '__main__':
         print("Usage: python upscale_and_process.py input.png output.png [scale_factor]")
         sys.exit(1)
 
-    scale = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    scale = float(sys.argv[3]) if len(sys.argv) > 3 else 4
+    if scale <= 0:
+        print("Error: scale_factor must be a positive number")
+        sys.exit(1)
+
     upscale_image(sys.argv[1], sys.argv[2], scale)